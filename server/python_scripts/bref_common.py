@@ -0,0 +1,471 @@
+"""
+Shared helpers for the Basketball Reference fetch scripts.
+
+Database setup, player resolution, game log writes, request pacing, the
+shared HTTP session and box score page parsing used by every
+fetch_bref_*.py script.
+"""
+
+import os
+import re
+import time
+import threading
+from datetime import date, datetime, timedelta
+
+import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+
+# Basketball Reference allows 20 requests/minute; spacing requests a fixed
+# 3.2s apart keeps any 60s window to 19, retries included
+REQUEST_INTERVAL = 3.2
+
+# Largest multiple of REQUEST_INTERVAL to back off to when throttled
+MAX_BACKOFF = 8
+
+# Tries per page, each taking its own rate limiter slot, and the responses
+# that are worth another try
+MAX_ATTEMPTS = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Longest Retry-After honoured; a rate limit lockout can ask for an hour,
+# which isn't worth holding every fetch for
+MAX_RETRY_AFTER = 60
+
+# Pages fetched concurrently (still paced by the rate limiter)
+MAX_WORKERS = 3
+
+# Pages for dates older than this are final and can be cached on disk
+CACHE_AFTER_DAYS = 2
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bref_cache.sqlite")
+
+# Basketball Reference team abbreviations to standard NBA abbreviations
+TEAM_ABBR_MAP = {
+    "ATL": "ATL", "BOS": "BOS", "BRK": "BKN", "BKN": "BKN",
+    "CHA": "CHA", "CHI": "CHI", "CLE": "CLE", "DAL": "DAL",
+    "DEN": "DEN", "DET": "DET", "GSW": "GSW", "HOU": "HOU",
+    "IND": "IND", "LAC": "LAC", "LAL": "LAL", "MEM": "MEM",
+    "MIA": "MIA", "MIL": "MIL", "MIN": "MIN", "NOP": "NOP",
+    "NYK": "NYK", "OKC": "OKC", "ORL": "ORL", "PHI": "PHI",
+    "PHO": "PHX", "PHX": "PHX", "POR": "POR", "SAC": "SAC",
+    "SAS": "SAS", "TOR": "TOR", "UTA": "UTA", "WAS": "WAS",
+}
+
+# Box score links on a date's scoreboard, e.g. /boxscores/202502060ATL.html
+BOX_SCORE_LINK_RE = re.compile(rb'/boxscores/(\d{8})0([A-Z]{3})\.html')
+# Each team's basic box score table, e.g. <table id="box-ATL-game-basic">
+BASIC_TABLES_XPATH = '//table[starts-with(@id, "box-") and substring(@id, 8) = "-game-basic"]'
+
+# Request headers to avoid blocking
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Connection": "keep-alive",
+}
+
+
+def setup_database(conn):
+    """Ensure required tables exist."""
+    # Pipelined so the DDL goes out in one round-trip
+    with conn.pipeline(), conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS players (
+                player_id SERIAL PRIMARY KEY,
+                full_name VARCHAR(255) NOT NULL,
+                team_abbreviation VARCHAR(5),
+                headshot_url VARCHAR(255)
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS player_game_logs (
+                game_log_id SERIAL PRIMARY KEY,
+                player_id INT REFERENCES players(player_id),
+                season VARCHAR(10) NOT NULL,
+                game_date DATE NOT NULL,
+                opponent VARCHAR(5),
+                min REAL,
+                pts INT,
+                reb INT,
+                ast INT,
+                stl INT,
+                blk INT,
+                UNIQUE(player_id, season, game_date)
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS advanced_box_scores (
+                game_log_id INT PRIMARY KEY REFERENCES player_game_logs(game_log_id),
+                offensive_rating REAL,
+                defensive_rating REAL,
+                net_rating REAL,
+                effective_fg_percentage REAL,
+                true_shooting_percentage REAL,
+                usage_percentage REAL
+            );
+        """)
+    conn.commit()
+    migrate_players(conn)
+
+
+def migrate_players(conn):
+    """Give older players tables a player_id default and a unique full_name.
+
+    Databases created by the JS ingest scripts have neither. Each step runs
+    only when it's still needed, so an up-to-date database doesn't take the
+    ALTER's ACCESS EXCLUSIVE lock, and the unique index is skipped with a
+    warning while duplicate names remain.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT column_default IS NOT NULL, to_regclass('players_full_name_key') IS NOT NULL
+            FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'players' AND column_name = 'player_id'
+        """)
+        has_default, has_name_key = cur.fetchone()
+
+        if not has_default:
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS players_player_id_seq OWNED BY players.player_id")
+            cur.execute("""
+                ALTER TABLE players
+                ALTER COLUMN player_id SET DEFAULT nextval('players_player_id_seq')
+            """)
+
+        # Ids inserted explicitly (e.g. by the JS scripts) can leave the
+        # sequence behind the table
+        cur.execute("""
+            SELECT setval(seq, max_id)
+            FROM (
+                SELECT pg_get_serial_sequence('players', 'player_id')::regclass AS seq,
+                       (SELECT MAX(player_id) FROM players) AS max_id
+            ) s
+            WHERE max_id > COALESCE(pg_sequence_last_value(seq), 0)
+        """)
+
+        if not has_name_key:
+            cur.execute("""
+                SELECT full_name FROM players
+                GROUP BY full_name HAVING COUNT(*) > 1
+                ORDER BY full_name
+            """)
+            duplicates = [name for (name,) in cur.fetchall()]
+            if duplicates:
+                print(f"  Warning: {len(duplicates)} duplicate player names "
+                      f"(e.g. {duplicates[0]}); not adding players_full_name_key")
+            else:
+                cur.execute("CREATE UNIQUE INDEX players_full_name_key ON players (full_name)")
+    conn.commit()
+
+
+def load_player_cache(conn):
+    """Load every stored player as full_name -> (player_id, team_abbreviation)."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT player_id, full_name, team_abbreviation FROM players")
+        return {name: (player_id, team) for player_id, name, team in cur.fetchall()}
+
+
+def sync_players(conn, player_cache, player_teams):
+    """Create unknown players and apply team changes.
+
+    player_teams maps full_name -> team abbreviation. Names are resolved
+    against player_cache, which is updated in place with the results; only
+    new players and players whose team changed are sent to the database.
+    Existing players are matched by player_id, so this works whether or not
+    full_name is unique in the table.
+    """
+    new_players = {name: team for name, team in player_teams.items() if name not in player_cache}
+
+    with conn.cursor() as cur:
+        if new_players:
+            # New players take their id from the column default (see
+            # migrate_players). With players_full_name_key in place, a name a
+            # concurrent run inserted first is skipped here and read back
+            # below; without it (duplicate names remain) concurrent runs can
+            # each insert the same new name
+            cur.execute(
+                """
+                INSERT INTO players (full_name, team_abbreviation)
+                SELECT * FROM unnest(%s::varchar[], %s::varchar[])
+                ON CONFLICT DO NOTHING
+                RETURNING player_id, full_name
+                """,
+                (list(new_players), list(new_players.values()))
+            )
+            for player_id, name in cur.fetchall():
+                player_cache[name] = (player_id, new_players[name])
+                print(f"  Created new player: {name} (ID: {player_id})")
+
+            conflicting = [name for name in new_players if name not in player_cache]
+            if conflicting:
+                cur.execute(
+                    "SELECT player_id, full_name, team_abbreviation FROM players WHERE full_name = ANY(%s)",
+                    (conflicting,)
+                )
+                for player_id, name, team in cur.fetchall():
+                    player_cache[name] = (player_id, team)
+
+        moved_players = {
+            name: team for name, team in player_teams.items()
+            if player_cache[name][1] != team
+        }
+        if moved_players:
+            cur.execute(
+                """
+                UPDATE players p
+                SET team_abbreviation = u.team_abbreviation
+                FROM unnest(%s::int[], %s::varchar[]) AS u(player_id, team_abbreviation)
+                WHERE p.player_id = u.player_id
+                """,
+                ([player_cache[name][0] for name in moved_players], list(moved_players.values()))
+            )
+            for name, team in moved_players.items():
+                player_cache[name] = (player_cache[name][0], team)
+
+
+class RateLimiter:
+    """Space out requests across threads to respect rate limits.
+
+    Each call to wait() reserves the next request slot, so concurrent
+    fetches overlap their network time but start exactly `interval` seconds
+    apart. The interval stretches when the server throttles us and eases
+    back toward the base interval as requests succeed.
+    """
+
+    def __init__(self, interval, max_backoff=MAX_BACKOFF):
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.backoff = 1.0
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        """Block until this caller's request slot comes up."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self.interval * self.backoff
+        if start > now:
+            time.sleep(start - now)
+
+    def success(self):
+        """Ease the interval back toward its base after a good response."""
+        with self._lock:
+            self.backoff = max(1.0, self.backoff * 0.7)
+
+    def throttled(self, retry_after=0):
+        """Double the interval after a 429 or timeout.
+
+        retry_after (seconds, e.g. from a Retry-After header) also holds
+        back the next slot until it has passed.
+        """
+        with self._lock:
+            self.backoff = min(self.max_backoff, self.backoff * 2)
+            self._next_time = max(self._next_time, time.monotonic() + retry_after)
+
+
+# One limiter per process, shared by every page fetch
+RATE_LIMITER = RateLimiter(REQUEST_INTERVAL)
+
+# Shared keep-alive session; only requests made with an explicit expire_after
+# are cached (see fetch_page). The adapter doesn't retry: fetch_page does,
+# so every attempt goes through the rate limiter
+SESSION = requests_cache.CachedSession(CACHE_PATH, expire_after=requests_cache.DO_NOT_CACHE)
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=MAX_WORKERS))
+
+
+def fetch_page(url, target_date=None, **kwargs):
+    """GET a Basketball Reference page, paced by the shared rate limiter.
+
+    Pages for a target_date at least CACHE_AFTER_DAYS old never change, so
+    they are kept in the on-disk cache and served from it on reruns without
+    waiting on the rate limiter. Throttled, failed and timed-out requests are
+    retried up to MAX_ATTEMPTS times, each attempt waiting for its own slot;
+    the last response is returned even if it's still an error. Extra keyword
+    arguments go to SESSION.get.
+    """
+    if target_date and target_date <= date.today() - timedelta(days=CACHE_AFTER_DAYS):
+        expire_after = requests_cache.NEVER_EXPIRE
+        if SESSION.cache.contains(url=url):
+            return SESSION.get(url, timeout=30, expire_after=expire_after, **kwargs)
+    else:
+        expire_after = requests_cache.DO_NOT_CACHE
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        RATE_LIMITER.wait()
+        try:
+            response = SESSION.get(url, timeout=30, expire_after=expire_after, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            RATE_LIMITER.throttled()
+            if attempt == MAX_ATTEMPTS:
+                raise
+            continue
+
+        if response.status_code not in RETRY_STATUSES:
+            RATE_LIMITER.success()
+            break
+        retry_after = response.headers.get("Retry-After", "")
+        RATE_LIMITER.throttled(min(int(retry_after), MAX_RETRY_AFTER) if retry_after.isdigit() else 0)
+    return response
+
+
+def get_games_on_date(target_date):
+    """Get list of games (home team abbreviations) for a date."""
+    url = f"https://www.basketball-reference.com/boxscores/?month={target_date.month}&day={target_date.day}&year={target_date.year}"
+
+    try:
+        response = fetch_page(url, target_date)
+        response.raise_for_status()
+
+        # Match on the raw bytes; only the team codes need decoding
+        date_str = target_date.strftime("%Y%m%d").encode()
+        matches = [
+            team.decode() for day, team in BOX_SCORE_LINK_RE.findall(response.content)
+            if day == date_str
+        ]
+
+        return list(set(matches))
+    except Exception as exc:
+        print(f"  Error getting games for {target_date}: {exc}")
+        return []
+
+
+def get_season_schedule(season_end_year, start_date, end_date):
+    """Map each game date in a range to its home teams from the monthly schedule pages.
+
+    One schedule page per month replaces a scoreboard request per day.
+    Returns None if any month can't be read, so the caller can fall back
+    to get_games_on_date.
+    """
+    schedule = {}
+    month_start = start_date.replace(day=1)
+
+    while month_start <= end_date:
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        month_name = month_start.strftime("%B").lower()
+        url = f"https://www.basketball-reference.com/leagues/NBA_{season_end_year}_games-{month_name}.html"
+
+        try:
+            # A month's schedule is final (and cacheable) once its last day is
+            response = fetch_page(url, next_month - timedelta(days=1))
+            response.raise_for_status()
+        except Exception as exc:
+            print(f"  Error getting schedule for {month_start.strftime('%B %Y')}: {exc}")
+            return None
+
+        # Completed games link to their box scores, e.g. /boxscores/202502060ATL.html
+        for day, team in BOX_SCORE_LINK_RE.findall(response.content):
+            game_date = datetime.strptime(day.decode(), "%Y%m%d").date()
+            if start_date <= game_date <= end_date:
+                schedule.setdefault(game_date, set()).add(team.decode())
+
+        month_start = next_month
+
+    return {game_date: sorted(teams) for game_date, teams in schedule.items()}
+
+
+def get_season_string(game_date):
+    """Get season string for a given date."""
+    if game_date.month >= 10:
+        season_end_year = game_date.year + 1
+    else:
+        season_end_year = game_date.year
+
+    season_start_year = season_end_year - 1
+    return f"{season_start_year}-{str(season_end_year)[2:]}"
+
+
+def parse_minutes(mp_str):
+    """Parse minutes played from MM:SS format."""
+    if not mp_str:
+        return 0
+    try:
+        minutes, sep, seconds = mp_str.partition(':')
+        if sep:
+            return int(minutes) + int(seconds) / 60
+        return float(mp_str)
+    except ValueError:
+        return 0
+
+
+def parse_int(val):
+    """Parse integer value, returning 0 for invalid values."""
+    if not val:
+        return 0
+    try:
+        return int(val)
+    except ValueError:
+        return 0
+
+
+def table_rows(table):
+    """Yield (player name, {data-stat: text}) for each player row of a box score table."""
+    # "Reserves" header rows are class="thead" and Team Totals live in <tfoot>
+    for row in table.xpath('./tbody/tr[not(contains(@class, "thead"))]'):
+        name_cells = row.xpath('./th[@data-stat="player"]')
+        if not name_cells:
+            continue
+        player_name = name_cells[0].text_content().strip()
+        if not player_name:
+            continue
+        yield player_name, {td.get('data-stat'): td.text for td in row.iterfind('td')}
+
+
+def upsert_game_logs(cur, rows):
+    """Upsert game log rows in one multi-row statement.
+
+    Rows are (player_id, season, game_date, opponent, min, pts, reb, ast,
+    stl, blk) tuples, sent as one array per column and expanded with
+    unnest(), so the batch is parsed and planned once. Later duplicates of
+    a player's game replace earlier ones, since ON CONFLICT can't touch a
+    row twice.
+    """
+    rows = list({row[:3]: row for row in rows}.values())
+    cur.execute(
+        """
+        INSERT INTO player_game_logs
+        (player_id, season, game_date, opponent, min, pts, reb, ast, stl, blk)
+        SELECT * FROM unnest(
+            %s::int[], %s::varchar[], %s::date[], %s::varchar[], %s::real[],
+            %s::int[], %s::int[], %s::int[], %s::int[], %s::int[]
+        )
+        ON CONFLICT (player_id, season, game_date) DO UPDATE
+        SET min = EXCLUDED.min, pts = EXCLUDED.pts, reb = EXCLUDED.reb,
+            ast = EXCLUDED.ast, stl = EXCLUDED.stl, blk = EXCLUDED.blk;
+        """,
+        [list(column) for column in zip(*rows)]
+    )
+
+
+def get_completed_dates(conn, season_string, schedule, require_advanced=False):
+    """Return scheduled dates whose games all have game logs already.
+
+    schedule maps game date -> home teams for that date's games. Every team
+    that played shows up as some player's opponent, so a date is complete
+    once its game logs name two opponents per scheduled game. With
+    require_advanced, only opponents whose logs have advanced_box_scores
+    rows count, so dates written by the basic-only scripts aren't skipped.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT gl.game_date,
+                   COUNT(DISTINCT gl.opponent),
+                   COUNT(DISTINCT gl.opponent) FILTER (WHERE abs.game_log_id IS NOT NULL)
+            FROM player_game_logs gl
+            LEFT JOIN advanced_box_scores abs ON gl.game_log_id = abs.game_log_id
+            WHERE gl.season = %s AND gl.game_date = ANY(%s)
+            GROUP BY gl.game_date
+        """, (season_string, list(schedule)))
+        return {
+            game_date for game_date, teams, advanced_teams in cur.fetchall()
+            if (advanced_teams if require_advanced else teams) >= 2 * len(schedule[game_date])
+        }
+
+
+def flush_game_logs(conn, rows):
+    """Upsert buffered game log rows and commit; returns rows written."""
+    # Pipelined so the statement and its commit share a round-trip
+    with conn.pipeline(), conn.cursor() as cur:
+        upsert_game_logs(cur, rows)
+        conn.commit()
+        return cur.rowcount
@@ -0,0 +1,37 @@
+"""
+Database connection helpers shared by the fetch scripts.
+
+Reads DATABASE_URL (or the PG* variables for a local database) from the
+environment and .env, which is loaded once when this module is imported.
+"""
+
+import os
+
+import psycopg
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def get_db_connection():
+    """Get a database connection."""
+    # Keepalives stop idle connections being dropped during long scrapes
+    database_url = os.getenv("DATABASE_URL")
+    if database_url:
+        return psycopg.connect(database_url, sslmode="require", keepalives=1, keepalives_idle=30)
+
+    return psycopg.connect(
+        dbname=os.getenv("PGDATABASE", "nba_stats"),
+        user=os.getenv("PGUSER", "christiankim"),
+        password=os.getenv("PGPASSWORD", ""),
+        host=os.getenv("PGHOST", "localhost"),
+        port=os.getenv("PGPORT", "5432"),
+        keepalives=1,
+        keepalives_idle=30,
+    )
+
+
+def log_connection_info(conn):
+    """Log database connection details."""
+    info = conn.info
+    print(f"Connected to DB: {info.dbname} as {info.user}@{info.host}:{info.port}")
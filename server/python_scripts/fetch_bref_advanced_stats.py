@@ -15,18 +15,21 @@ Stats fetched:
 Run this after fetch_bref_rosters_and_logs.py or fetch_bref_yesterdays_games.py.
 """
 
-import os
 import sys
-import time
-import random
-import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
-from io import StringIO
 
-import requests
-import pandas as pd
-import psycopg
-from dotenv import load_dotenv
+import lxml.html
+
+from bref_common import (
+    MAX_WORKERS,
+    TEAM_ABBR_MAP,
+    fetch_page,
+    get_games_on_date,
+    get_season_string,
+    table_rows,
+)
+from db import get_db_connection, log_connection_info
 
 # Configuration
 TEST_MODE = False
@@ -45,70 +48,16 @@ SEASON_END_DATES = {
     2026: date(2026, 4, 12),
 }
 
-# Basketball Reference team abbreviations (some differ from standard)
-TEAM_ABBR_MAP = {
-    "ATL": "ATL", "BOS": "BOS", "BRK": "BKN", "BKN": "BKN",
-    "CHA": "CHA", "CHI": "CHI", "CLE": "CLE", "DAL": "DAL",
-    "DEN": "DEN", "DET": "DET", "GSW": "GSW", "HOU": "HOU",
-    "IND": "IND", "LAC": "LAC", "LAL": "LAL", "MEM": "MEM",
-    "MIA": "MIA", "MIL": "MIL", "MIN": "MIN", "NOP": "NOP",
-    "NYK": "NYK", "OKC": "OKC", "ORL": "ORL", "PHI": "PHI",
-    "PHO": "PHX", "PHX": "PHX", "POR": "POR", "SAC": "SAC",
-    "SAS": "SAS", "TOR": "TOR", "UTA": "UTA", "WAS": "WAS",
-}
-
-# Request headers to avoid blocking
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-    "Accept-Language": "en-US,en;q=0.5",
-    "Connection": "keep-alive",
-}
-
-
-def get_db_connection():
-    """Get a database connection."""
-    load_dotenv()
-    database_url = os.getenv("DATABASE_URL")
-    if database_url:
-        return psycopg.connect(database_url, sslmode="require")
-
-    return psycopg.connect(
-        dbname=os.getenv("PGDATABASE", "nba_stats"),
-        user=os.getenv("PGUSER", "christiankim"),
-        password=os.getenv("PGPASSWORD", ""),
-        host=os.getenv("PGHOST", "localhost"),
-        port=os.getenv("PGPORT", "5432"),
-    )
-
-
-def log_connection_info(conn):
-    """Log database connection details."""
-    info = conn.info
-    print(f"Connected to DB: {info.dbname} as {info.user}@{info.host}:{info.port}")
-
+# Each team's advanced box score table, e.g. <table ... id="box-ATL-game-advanced">
+ADVANCED_TABLES_XPATH = '//table[starts-with(@id, "box-") and substring(@id, 8) = "-game-advanced"]'
 
-def random_delay(min_sec=3, max_sec=5):
-    """Add delay to respect rate limits."""
-    time.sleep(random.uniform(min_sec, max_sec))
-
-
-def get_games_on_date(target_date):
-    """Get list of games (home team abbreviations) for a date."""
-    url = f"https://www.basketball-reference.com/boxscores/?month={target_date.month}&day={target_date.day}&year={target_date.year}"
 
+def parse_stat(value):
+    """Parse a box score cell as a float, using 0.0 for blank values."""
     try:
-        response = requests.get(url, headers=HEADERS, timeout=30)
-        response.raise_for_status()
-
-        # Find all box score links like /boxscores/202502060ATL.html
-        pattern = rf'/boxscores/{target_date.strftime("%Y%m%d")}0([A-Z]{{3}})\.html'
-        matches = re.findall(pattern, response.text)
-
-        return list(set(matches))  # Unique home teams
-    except Exception as exc:
-        print(f"  Error getting games for {target_date}: {exc}")
-        return []
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
 
 
 def fetch_advanced_box_score(target_date, home_team):
@@ -117,105 +66,46 @@ def fetch_advanced_box_score(target_date, home_team):
     url = f"https://www.basketball-reference.com/boxscores/{date_str}0{home_team}.html"
 
     try:
-        response = requests.get(url, headers=HEADERS, timeout=30)
+        response = fetch_page(url, target_date)
         response.raise_for_status()
 
-        # Parse the HTML to find advanced stats tables
-        # Basketball Reference has tables with id like "box-{TEAM}-game-advanced"
-        html = response.text
+        # Parse the page once and pick out the advanced stats tables
+        page = lxml.html.fromstring(response.content)
 
         # Find both teams' advanced stats
         players_stats = []
 
         # Look for advanced box score tables
         # They have IDs like "box-ATL-game-advanced" and "box-BOS-game-advanced"
-        pattern = r'id="box-([A-Z]{3})-game-advanced"'
-        teams = re.findall(pattern, html)
-
-        for team in teams:
-            table_id = f"box-{team}-game-advanced"
-
-            # Extract the table HTML
-            table_pattern = rf'<table[^>]*id="{table_id}"[^>]*>.*?</table>'
-            table_match = re.search(table_pattern, html, re.DOTALL)
-
-            if not table_match:
-                continue
-
-            table_html = table_match.group(0)
+        for table in page.xpath(ADVANCED_TABLES_XPATH):
+            team = table.get('id')[len('box-'):-len('-game-advanced')]
 
             try:
-                # Use pandas to parse the table
-                dfs = pd.read_html(StringIO(table_html))
-                if not dfs:
-                    continue
-
-                df = dfs[0]
-
-                # Handle multi-level columns if present
-                if isinstance(df.columns, pd.MultiIndex):
-                    df.columns = df.columns.get_level_values(-1)
-
-                # Get the player name column (usually first column or "Starters"/"Reserves")
-                name_col = df.columns[0]
-
-                for _, row in df.iterrows():
-                    player_name = str(row[name_col])
-
-                    # Skip header rows and totals
-                    if player_name in ['Starters', 'Reserves', 'Team Totals', 'nan', '']:
-                        continue
-                    if 'Did Not' in player_name or 'Not With' in player_name:
+                team_abbr = TEAM_ABBR_MAP.get(team, team)
+
+                # Cells are tagged by stat, e.g. <td data-stat="off_rtg">
+                for player_name, cells in table_rows(table):
+                    # Players who did not play only have a "reason" cell
+                    ortg = parse_stat(cells.get('off_rtg'))
+                    drtg = parse_stat(cells.get('def_rtg'))
+                    if ortg == 0 and drtg == 0:
                         continue
 
-                    # Extract stats - column names may vary
-                    try:
-                        # Parse percentage values (may be like ".410" or "41.0")
-                        def parse_pct(val):
-                            if val is None or pd.isna(val):
-                                return 0.0
-                            s = str(val).strip()
-                            if s.startswith('.'):
-                                s = '0' + s
-                            return float(s) if s else 0.0
-
-                        def parse_rating(val):
-                            if val is None or pd.isna(val):
-                                return 0.0
-                            try:
-                                return float(val)
-                            except (ValueError, TypeError):
-                                return 0.0
+                    # Net rating is ORtg - DRtg
+                    net_rtg = ortg - drtg if ortg and drtg else 0.0
 
+                    players_stats.append({
+                        'name': player_name,
+                        'team': team_abbr,
                         # TS% and eFG% come as decimals like ".410", multiply by 100
-                        ts_pct = parse_pct(row.get('TS%')) * 100
-                        efg_pct = parse_pct(row.get('eFG%')) * 100
-                        ortg = parse_rating(row.get('ORtg'))
-                        drtg = parse_rating(row.get('DRtg'))
+                        'ts_pct': parse_stat(cells.get('ts_pct')) * 100,
+                        'efg_pct': parse_stat(cells.get('efg_pct')) * 100,
+                        'ortg': ortg,
+                        'drtg': drtg,
+                        'net_rtg': net_rtg,
                         # USG% is already in percentage format (e.g., "33.4")
-                        usg_pct = parse_pct(row.get('USG%'))
-
-                        # Skip if we couldn't parse any meaningful stats
-                        if ortg == 0 and drtg == 0:
-                            continue
-
-                        # Net rating is ORtg - DRtg
-                        net_rtg = ortg - drtg if ortg and drtg else 0.0
-
-                        team_abbr = TEAM_ABBR_MAP.get(team, team)
-
-                        players_stats.append({
-                            'name': player_name,
-                            'team': team_abbr,
-                            'ts_pct': ts_pct,
-                            'efg_pct': efg_pct,
-                            'ortg': ortg,
-                            'drtg': drtg,
-                            'net_rtg': net_rtg,
-                            'usg_pct': usg_pct,
-                        })
-                    except (ValueError, TypeError):
-                        continue
+                        'usg_pct': parse_stat(cells.get('usg_pct')),
+                    })
 
             except Exception as exc:
                 print(f"    Error parsing table for {team}: {exc}")
@@ -228,29 +118,81 @@ def fetch_advanced_box_score(target_date, home_team):
         return []
 
 
-def get_game_log_id(conn, player_name, game_date, season_string):
-    """Get game_log_id for a player's game."""
+def get_game_log_ids(conn, game_date, season_string):
+    """Map player full name to game_log_id for every game log on a date.
+
+    Runs once per date with the same text, so it is prepared server-side.
+    """
     with conn.cursor() as cur:
         cur.execute("""
-            SELECT gl.game_log_id
+            SELECT p.full_name, gl.game_log_id
             FROM player_game_logs gl
             JOIN players p ON gl.player_id = p.player_id
-            WHERE p.full_name = %s
-              AND gl.game_date = %s
+            WHERE gl.game_date = %s
               AND gl.season = %s
-        """, (player_name, game_date, season_string))
-        row = cur.fetchone()
-        return row[0] if row else None
+        """, (game_date, season_string), prepare=True)
+        return dict(cur.fetchall())
+
 
+def get_dates_missing_advanced(conn, season_string):
+    """Return the game dates in a season where some team has no advanced stats.
 
-def upsert_advanced_stats(conn, game_log_id, stats):
-    """Insert or update advanced stats for a game log."""
+    Some players never get an advanced row (no ratings in garbage time, or
+    a name that doesn't match a stored player), so a date counts as done
+    once each team's side of its games, i.e. each opponent in its game
+    logs, has at least one advanced row.
+    """
     with conn.cursor() as cur:
+        cur.execute("""
+            SELECT gl.game_date
+            FROM player_game_logs gl
+            LEFT JOIN advanced_box_scores abs ON gl.game_log_id = abs.game_log_id
+            WHERE gl.season = %s
+            GROUP BY gl.game_date
+            HAVING COUNT(DISTINCT gl.opponent)
+                 > COUNT(DISTINCT gl.opponent) FILTER (WHERE abs.game_log_id IS NOT NULL)
+        """, (season_string,))
+        return {row[0] for row in cur.fetchall()}
+
+
+def upsert_advanced_stats_batch(conn, rows):
+    """Insert or update advanced stats for many game logs in one batch.
+
+    Each row is (game_log_id, ts_pct, efg_pct, ortg, drtg, net_rtg, usg_pct).
+    Rows are streamed into a temp table with COPY and merged from there, since
+    COPY itself can't resolve conflicts with existing rows. The merge runs
+    once per date, so it is prepared server-side.
+    """
+    if not rows:
+        return 0
+
+    # A game log can only be updated once per statement; keep its last row
+    rows = list({row[0]: row for row in rows}.values())
+
+    with conn.cursor() as cur:
+        # Emptied per batch so it doesn't depend on when the caller commits
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS advanced_stats_stage (
+                game_log_id INT,
+                true_shooting_percentage REAL,
+                effective_fg_percentage REAL,
+                offensive_rating REAL,
+                defensive_rating REAL,
+                net_rating REAL,
+                usage_percentage REAL
+            )
+        """)
+        cur.execute("TRUNCATE advanced_stats_stage")
+        with cur.copy("COPY advanced_stats_stage FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
         cur.execute("""
             INSERT INTO advanced_box_scores
             (game_log_id, true_shooting_percentage, effective_fg_percentage,
              offensive_rating, defensive_rating, net_rating, usage_percentage)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            SELECT game_log_id, true_shooting_percentage, effective_fg_percentage,
+                   offensive_rating, defensive_rating, net_rating, usage_percentage
+            FROM advanced_stats_stage
             ON CONFLICT (game_log_id) DO UPDATE SET
                 true_shooting_percentage = EXCLUDED.true_shooting_percentage,
                 effective_fg_percentage = EXCLUDED.effective_fg_percentage,
@@ -258,21 +200,12 @@ def upsert_advanced_stats(conn, game_log_id, stats):
                 defensive_rating = EXCLUDED.defensive_rating,
                 net_rating = EXCLUDED.net_rating,
                 usage_percentage = EXCLUDED.usage_percentage
-            RETURNING game_log_id
-        """, (
-            game_log_id,
-            stats['ts_pct'],
-            stats['efg_pct'],
-            stats['ortg'],
-            stats['drtg'],
-            stats['net_rtg'],
-            stats['usg_pct'],
-        ))
-        return cur.fetchone() is not None
+        """, prepare=True)
+    return len(rows)
 
 
-def process_date(conn, target_date, season_string, dry_run=False):
-    """Process advanced stats for all games on a specific date."""
+def fetch_date(target_date):
+    """Fetch advanced stats for every game on a date, one list per game."""
     print(f"\nProcessing {target_date.isoformat()}...")
 
     # Get list of games
@@ -280,42 +213,75 @@ def process_date(conn, target_date, season_string, dry_run=False):
 
     if not home_teams:
         print("  No games found")
-        return 0, 0
+        return []
 
     print(f"  Found {len(home_teams)} games: {', '.join(home_teams)}")
 
-    total_processed = 0
-    total_inserted = 0
-
-    for home_team in home_teams:
-        random_delay(3, 5)  # Respect rate limits
-
-        players_stats = fetch_advanced_box_score(target_date, home_team)
+    # Fetch the games concurrently; the shared rate limiter keeps requests spaced out
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(
+            fetch_advanced_box_score, [target_date] * len(home_teams), home_teams
+        ))
 
+    games = []
+    for home_team, players_stats in zip(home_teams, results):
         if not players_stats:
             print(f"    No advanced stats found for {home_team} game")
             continue
 
         print(f"    {home_team} game: {len(players_stats)} players")
+        games.append(players_stats)
+
+    return games
 
+
+def dry_run_date(target_date):
+    """Fetch and print a sample of a date's advanced stats without writing them."""
+    total_processed = 0
+
+    for players_stats in fetch_date(target_date):
         for stats in players_stats:
-            if dry_run:
-                if total_processed < 5:
-                    print(f"      {stats['name']}: TS%={stats['ts_pct']:.1f}%, eFG%={stats['efg_pct']:.1f}%, ORtg={stats['ortg']:.0f}, DRtg={stats['drtg']:.0f}, USG%={stats['usg_pct']:.1f}%")
-                total_processed += 1
-                continue
+            if total_processed < 5:
+                print(f"      {stats['name']}: TS%={stats['ts_pct']:.1f}%, eFG%={stats['efg_pct']:.1f}%, ORtg={stats['ortg']:.0f}, DRtg={stats['drtg']:.0f}, USG%={stats['usg_pct']:.1f}%")
+            total_processed += 1
+
+    if total_processed > 5:
+        print(f"      ... and {total_processed - 5} more players")
+
+    return total_processed
+
 
+def process_date(conn, target_date, season_string):
+    """Process advanced stats for all games on a specific date."""
+    games = fetch_date(target_date)
+    if not games:
+        return 0, 0
+
+    total_processed = 0
+    # Look up every game log for the date once instead of once per player
+    game_log_ids = get_game_log_ids(conn, target_date, season_string)
+    pending = []  # (game_log_id, ts_pct, efg_pct, ortg, drtg, net_rtg, usg_pct)
+
+    for players_stats in games:
+        for stats in players_stats:
             # Find matching game log
-            game_log_id = get_game_log_id(conn, stats['name'], target_date, season_string)
+            game_log_id = game_log_ids.get(stats['name'])
 
             if game_log_id:
-                if upsert_advanced_stats(conn, game_log_id, stats):
-                    total_inserted += 1
+                pending.append((
+                    game_log_id,
+                    stats['ts_pct'],
+                    stats['efg_pct'],
+                    stats['ortg'],
+                    stats['drtg'],
+                    stats['net_rtg'],
+                    stats['usg_pct'],
+                ))
 
             total_processed += 1
 
-    if dry_run and total_processed > 5:
-        print(f"      ... and {total_processed - 5} more players")
+    # Write the whole date's advanced stats in a single batch
+    total_inserted = upsert_advanced_stats_batch(conn, pending)
 
     return total_processed, total_inserted
 
@@ -352,13 +318,12 @@ def main(season_end_year=2026):
             if home_teams:
                 sample_date = test_date
                 break
-            random_delay(1, 2)
 
         if not sample_date:
             print("No games found in the last 5 days")
             return
 
-        processed, _ = process_date(None, sample_date, season_string, dry_run=True)
+        processed = dry_run_date(sample_date)
 
         print("\n" + "=" * 60)
         print(f"TEST_MODE complete - found {processed} player stats.")
@@ -370,11 +335,19 @@ def main(season_end_year=2026):
     with get_db_connection() as conn:
         log_connection_info(conn)
 
+        # Only dates with game logs still missing advanced stats need fetching
+        missing_dates = get_dates_missing_advanced(conn, season_string)
+        print(f"Dates missing advanced stats: {len(missing_dates)}")
+
         current_date = season_start
         total_processed = 0
         total_inserted = 0
 
         while current_date <= end_date:
+            if current_date not in missing_dates:
+                current_date += timedelta(days=1)
+                continue
+
             processed, inserted = process_date(conn, current_date, season_string)
 
             total_processed += processed
@@ -392,15 +365,7 @@ def process_yesterday():
     """Process advanced stats for just yesterday's games."""
     today = date.today()
     yesterday = today - timedelta(days=1)
-
-    # Determine season string
-    if yesterday.month >= 10:
-        season_end_year = yesterday.year + 1
-    else:
-        season_end_year = yesterday.year
-
-    season_start_year = season_end_year - 1
-    season_string = f"{season_start_year}-{str(season_end_year)[2:]}"
+    season_string = get_season_string(yesterday)
 
     print("=" * 60)
     print("Fetch Advanced Box Scores (Yesterday Only)")
@@ -410,7 +375,7 @@ def process_yesterday():
 
     if TEST_MODE:
         print("\n** TEST_MODE enabled - DRY RUN **\n")
-        processed, _ = process_date(None, yesterday, season_string, dry_run=True)
+        processed = dry_run_date(yesterday)
         print(f"\nTEST_MODE complete - found {processed} player stats.")
         return
 
@@ -11,18 +11,30 @@ Usage:
     python fetch_bref_all_stats.py 2026         # Specific season
 """
 
-import os
 import sys
-import time
-import random
-import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import date, timedelta
-from io import StringIO
 
-import requests
-import pandas as pd
-import psycopg
-from dotenv import load_dotenv
+import lxml.html
+
+from bref_common import (
+    BASIC_TABLES_XPATH,
+    MAX_WORKERS,
+    TEAM_ABBR_MAP,
+    fetch_page,
+    get_completed_dates,
+    get_games_on_date,
+    get_season_schedule,
+    get_season_string,
+    load_player_cache,
+    parse_int,
+    parse_minutes,
+    setup_database,
+    sync_players,
+    table_rows,
+)
+from db import get_db_connection, log_connection_info
 
 # Configuration
 TEST_MODE = False
@@ -40,156 +52,48 @@ SEASON_END_DATES = {
     2026: date(2026, 4, 12),
 }
 
-# Basketball Reference team abbreviations to standard NBA abbreviations
-TEAM_ABBR_MAP = {
-    "ATL": "ATL", "BOS": "BOS", "BRK": "BKN", "BKN": "BKN",
-    "CHA": "CHA", "CHI": "CHI", "CLE": "CLE", "DAL": "DAL",
-    "DEN": "DEN", "DET": "DET", "GSW": "GSW", "HOU": "HOU",
-    "IND": "IND", "LAC": "LAC", "LAL": "LAL", "MEM": "MEM",
-    "MIA": "MIA", "MIL": "MIL", "MIN": "MIN", "NOP": "NOP",
-    "NYK": "NYK", "OKC": "OKC", "ORL": "ORL", "PHI": "PHI",
-    "PHO": "PHX", "PHX": "PHX", "POR": "POR", "SAC": "SAC",
-    "SAS": "SAS", "TOR": "TOR", "UTA": "UTA", "WAS": "WAS",
-}
-
-# Request headers to avoid blocking
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-    "Accept-Language": "en-US,en;q=0.5",
-    "Connection": "keep-alive",
-}
-
-
-def get_db_connection():
-    """Get a database connection."""
-    load_dotenv()
-    database_url = os.getenv("DATABASE_URL")
-    if database_url:
-        return psycopg.connect(database_url, sslmode="require")
-
-    return psycopg.connect(
-        dbname=os.getenv("PGDATABASE", "nba_stats"),
-        user=os.getenv("PGUSER", "christiankim"),
-        password=os.getenv("PGPASSWORD", ""),
-        host=os.getenv("PGHOST", "localhost"),
-        port=os.getenv("PGPORT", "5432"),
-    )
-
-
-def log_connection_info(conn):
-    """Log database connection details."""
-    info = conn.info
-    print(f"Connected to DB: {info.dbname} as {info.user}@{info.host}:{info.port}")
-
-
-def setup_database(conn):
-    """Ensure required tables exist."""
-    with conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS players (
-                player_id SERIAL PRIMARY KEY,
-                full_name VARCHAR(255) NOT NULL,
-                team_abbreviation VARCHAR(5),
-                headshot_url VARCHAR(255)
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS player_game_logs (
-                game_log_id SERIAL PRIMARY KEY,
-                player_id INT REFERENCES players(player_id),
-                season VARCHAR(10) NOT NULL,
-                game_date DATE NOT NULL,
-                opponent VARCHAR(5),
-                min REAL,
-                pts INT,
-                reb INT,
-                ast INT,
-                stl INT,
-                blk INT,
-                UNIQUE(player_id, season, game_date)
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS advanced_box_scores (
-                game_log_id INT PRIMARY KEY REFERENCES player_game_logs(game_log_id),
-                offensive_rating REAL,
-                defensive_rating REAL,
-                net_rating REAL,
-                effective_fg_percentage REAL,
-                true_shooting_percentage REAL,
-                usage_percentage REAL
-            );
-        """)
-    conn.commit()
-
-
-def random_delay(min_sec=3, max_sec=5):
-    """Add delay to respect rate limits."""
-    time.sleep(random.uniform(min_sec, max_sec))
-
-
-def get_games_on_date(target_date):
-    """Get list of games (home team abbreviations) for a date."""
-    url = f"https://www.basketball-reference.com/boxscores/?month={target_date.month}&day={target_date.day}&year={target_date.year}"
-
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=30)
-        response.raise_for_status()
-
-        pattern = rf'/boxscores/{target_date.strftime("%Y%m%d")}0([A-Z]{{3}})\.html'
-        matches = re.findall(pattern, response.text)
-
-        return list(set(matches))
-    except Exception as exc:
-        print(f"  Error getting games for {target_date}: {exc}")
-        return []
-
-
-def parse_minutes(mp_str):
-    """Parse minutes played from MM:SS format."""
-    if mp_str is None or pd.isna(mp_str):
-        return 0
-    try:
-        mp_str = str(mp_str).strip()
-        if ':' in mp_str:
-            parts = mp_str.split(':')
-            return int(parts[0]) + int(parts[1]) / 60
-        return float(mp_str)
-    except (ValueError, TypeError):
-        return 0
-
-
-def parse_int(val):
-    """Parse integer value, returning 0 for invalid values."""
-    if val is None or pd.isna(val):
-        return 0
-    try:
-        return int(float(val))
-    except (ValueError, TypeError):
-        return 0
+# full_name -> (player_id, team_abbreviation), loaded once per run and kept
+# current by sync_players
+PLAYER_ID_CACHE = {}
+
+
+@dataclass(slots=True)
+class PlayerGameStats:
+    """One player's box score line for a game; advanced stats stay None if missing."""
+    name: str
+    team: str
+    opponent: str
+    min: int
+    pts: int
+    reb: int
+    ast: int
+    stl: int
+    blk: int
+    ts_pct: float | None = None
+    efg_pct: float | None = None
+    ortg: float | None = None
+    drtg: float | None = None
+    net_rtg: float | None = None
+    usg_pct: float | None = None
 
 
 def parse_pct(val):
-    """Parse percentage value."""
-    if val is None or pd.isna(val):
+    """Parse percentage value (float() accepts decimals like ".410")."""
+    if not val:
         return 0.0
-    s = str(val).strip()
-    if s.startswith('.'):
-        s = '0' + s
     try:
-        return float(s) if s else 0.0
-    except (ValueError, TypeError):
+        return float(val)
+    except ValueError:
         return 0.0
 
 
 def parse_rating(val):
     """Parse rating value."""
-    if val is None or pd.isna(val):
+    if not val:
         return 0.0
     try:
         return float(val)
-    except (ValueError, TypeError):
+    except ValueError:
         return 0.0
 
 
@@ -199,15 +103,23 @@ def fetch_all_stats_for_game(target_date, home_team):
     url = f"https://www.basketball-reference.com/boxscores/{date_str}0{home_team}.html"
 
     try:
-        response = requests.get(url, headers=HEADERS, timeout=30)
+        response = fetch_page(url, target_date)
         response.raise_for_status()
 
-        html = response.text
+        # Pages without box score tables (e.g. postponed games) have nothing
+        # to parse; a byte search is much cheaper than building the tree
+        if b'-game-basic"' not in response.content:
+            return []
+
+        # Parse the page once; both box score tables are looked up by id
+        page = lxml.html.fromstring(response.content)
         players_data = {}  # name -> {basic stats, advanced stats}
 
         # Find all teams in this game
-        basic_pattern = r'id="box-([A-Z]{3})-game-basic"'
-        teams = re.findall(basic_pattern, html)
+        teams = [
+            table.get('id')[len('box-'):-len('-game-basic')]
+            for table in page.xpath(BASIC_TABLES_XPATH)
+        ]
 
         # Determine away team
         away_team = None
@@ -218,63 +130,38 @@ def fetch_all_stats_for_game(target_date, home_team):
 
         # Parse BASIC stats for each team
         for team in teams:
-            table_id = f"box-{team}-game-basic"
-            table_pattern = rf'<table[^>]*id="{table_id}"[^>]*>.*?</table>'
-            table_match = re.search(table_pattern, html, re.DOTALL)
-
-            if not table_match:
+            table = page.get_element_by_id(f"box-{team}-game-basic", None)
+            if table is None:
                 continue
 
-            try:
-                dfs = pd.read_html(StringIO(table_match.group(0)))
-                if not dfs:
-                    continue
-
-                df = dfs[0]
-                if isinstance(df.columns, pd.MultiIndex):
-                    df.columns = df.columns.get_level_values(-1)
-
-                name_col = df.columns[0]
+            team_abbr = TEAM_ABBR_MAP.get(team, team)
+            opponent_team = away_team if team == home_team else home_team
+            opponent = TEAM_ABBR_MAP.get(opponent_team, opponent_team)
 
-                for _, row in df.iterrows():
-                    player_name = str(row[name_col])
-
-                    if player_name in ['Starters', 'Reserves', 'Team Totals', 'nan', '']:
-                        continue
-                    if 'Did Not' in player_name or 'Not With' in player_name:
-                        continue
+            try:
+                for player_name, cells in table_rows(table):
                     if 'Inactive' in player_name:
                         continue
 
-                    minutes = parse_minutes(row.get('MP'))
-                    pts = parse_int(row.get('PTS'))
+                    # Players who did not play only have a "reason" cell
+                    minutes = parse_minutes(cells.get('mp'))
+                    pts = parse_int(cells.get('pts'))
 
                     # Skip players who didn't play
                     if minutes == 0 and pts == 0:
                         continue
 
-                    team_abbr = TEAM_ABBR_MAP.get(team, team)
-                    opponent = TEAM_ABBR_MAP.get(away_team if team == home_team else home_team,
-                                                  away_team if team == home_team else home_team)
-
-                    players_data[player_name] = {
-                        'name': player_name,
-                        'team': team_abbr,
-                        'opponent': opponent,
-                        'min': round(minutes),
-                        'pts': pts,
-                        'reb': parse_int(row.get('TRB')),
-                        'ast': parse_int(row.get('AST')),
-                        'stl': parse_int(row.get('STL')),
-                        'blk': parse_int(row.get('BLK')),
-                        # Advanced stats placeholders
-                        'ts_pct': None,
-                        'efg_pct': None,
-                        'ortg': None,
-                        'drtg': None,
-                        'net_rtg': None,
-                        'usg_pct': None,
-                    }
+                    players_data[player_name] = PlayerGameStats(
+                        name=player_name,
+                        team=team_abbr,
+                        opponent=opponent,
+                        min=round(minutes),
+                        pts=pts,
+                        reb=parse_int(cells.get('trb')),
+                        ast=parse_int(cells.get('ast')),
+                        stl=parse_int(cells.get('stl')),
+                        blk=parse_int(cells.get('blk')),
+                    )
 
             except Exception as exc:
                 print(f"    Error parsing basic table for {team}: {exc}")
@@ -282,50 +169,31 @@ def fetch_all_stats_for_game(target_date, home_team):
 
         # Parse ADVANCED stats for each team
         for team in teams:
-            table_id = f"box-{team}-game-advanced"
-            table_pattern = rf'<table[^>]*id="{table_id}"[^>]*>.*?</table>'
-            table_match = re.search(table_pattern, html, re.DOTALL)
-
-            if not table_match:
+            table = page.get_element_by_id(f"box-{team}-game-advanced", None)
+            if table is None:
                 continue
 
             try:
-                dfs = pd.read_html(StringIO(table_match.group(0)))
-                if not dfs:
-                    continue
-
-                df = dfs[0]
-                if isinstance(df.columns, pd.MultiIndex):
-                    df.columns = df.columns.get_level_values(-1)
-
-                name_col = df.columns[0]
-
-                for _, row in df.iterrows():
-                    player_name = str(row[name_col])
-
-                    if player_name in ['Starters', 'Reserves', 'Team Totals', 'nan', '']:
-                        continue
-                    if 'Did Not' in player_name or 'Not With' in player_name:
-                        continue
-
+                for player_name, cells in table_rows(table):
                     # Only add advanced stats if we have basic stats for this player
                     if player_name not in players_data:
                         continue
 
-                    ortg = parse_rating(row.get('ORtg'))
-                    drtg = parse_rating(row.get('DRtg'))
+                    ortg = parse_rating(cells.get('off_rtg'))
+                    drtg = parse_rating(cells.get('def_rtg'))
 
                     if ortg == 0 and drtg == 0:
                         continue
 
+                    stats = players_data[player_name]
                     # TS% and eFG% come as decimals, multiply by 100
-                    players_data[player_name]['ts_pct'] = parse_pct(row.get('TS%')) * 100
-                    players_data[player_name]['efg_pct'] = parse_pct(row.get('eFG%')) * 100
-                    players_data[player_name]['ortg'] = ortg
-                    players_data[player_name]['drtg'] = drtg
-                    players_data[player_name]['net_rtg'] = ortg - drtg if ortg and drtg else 0.0
+                    stats.ts_pct = parse_pct(cells.get('ts_pct')) * 100
+                    stats.efg_pct = parse_pct(cells.get('efg_pct')) * 100
+                    stats.ortg = ortg
+                    stats.drtg = drtg
+                    stats.net_rtg = ortg - drtg if ortg and drtg else 0.0
                     # USG% is already in percentage format
-                    players_data[player_name]['usg_pct'] = parse_pct(row.get('USG%'))
+                    stats.usg_pct = parse_pct(cells.get('usg_pct'))
 
             except Exception as exc:
                 print(f"    Error parsing advanced table for {team}: {exc}")
@@ -338,112 +206,112 @@ def fetch_all_stats_for_game(target_date, home_team):
         return []
 
 
-def get_or_create_player(conn, player_name, team_abbr):
-    """Get player_id by name, or create new player if not exists."""
-    with conn.cursor() as cur:
-        cur.execute(
-            "SELECT player_id FROM players WHERE full_name = %s",
-            (player_name,)
-        )
-        row = cur.fetchone()
-        if row:
-            cur.execute(
-                "UPDATE players SET team_abbreviation = %s WHERE player_id = %s",
-                (team_abbr, row[0])
-            )
-            return row[0]
-
-        cur.execute(
-            """
-            INSERT INTO players (player_id, full_name, team_abbreviation)
-            VALUES ((SELECT COALESCE(MAX(player_id), 0) + 1 FROM players), %s, %s)
-            RETURNING player_id
-            """,
-            (player_name, team_abbr)
+def insert_game_logs(cur, game_date, season_string, player_stats):
+    """Upsert game logs for many players and map player_id to game_log_id.
+
+    player_stats maps player_id -> PlayerGameStats for the players who played.
+    Rows are streamed into a temp table with COPY and merged from there, since
+    COPY itself can't resolve conflicts with existing rows.
+    """
+    if not player_stats:
+        return {}
+
+    # Kept for the session and emptied per batch rather than dropped on
+    # commit, so it also works when the caller wraps this in a savepoint
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS game_logs_stage (
+            player_id INT,
+            opponent VARCHAR(5),
+            min REAL,
+            pts INT,
+            reb INT,
+            ast INT,
+            stl INT,
+            blk INT
         )
-        player_id = cur.fetchone()[0]
-        print(f"    Created new player: {player_name} (ID: {player_id})")
-        return player_id
+    """)
+    cur.execute("TRUNCATE game_logs_stage")
+    with cur.copy("COPY game_logs_stage FROM STDIN") as copy:
+        for player_id, stats in player_stats.items():
+            copy.write_row((
+                player_id,
+                stats.opponent,
+                stats.min,
+                stats.pts,
+                stats.reb,
+                stats.ast,
+                stats.stl,
+                stats.blk,
+            ))
+    cur.execute(
+        """
+        INSERT INTO player_game_logs
+        (player_id, season, game_date, opponent, min, pts, reb, ast, stl, blk)
+        SELECT player_id, %s, %s, opponent, min, pts, reb, ast, stl, blk
+        FROM game_logs_stage
+        ON CONFLICT (player_id, season, game_date) DO UPDATE
+        SET min = EXCLUDED.min, pts = EXCLUDED.pts, reb = EXCLUDED.reb,
+            ast = EXCLUDED.ast, stl = EXCLUDED.stl, blk = EXCLUDED.blk
+        RETURNING player_id, game_log_id;
+        """,
+        (season_string, game_date),
+    )
+    return dict(cur.fetchall())
 
 
-def get_season_string(game_date):
-    """Get season string for a given date."""
-    if game_date.month >= 10:
-        season_end_year = game_date.year + 1
-    else:
-        season_end_year = game_date.year
-
-    season_start_year = season_end_year - 1
-    return f"{season_start_year}-{str(season_end_year)[2:]}"
-
-
-def insert_game_log(conn, player_id, game_date, stats, season_string):
-    """Insert a game log and return the game_log_id."""
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO player_game_logs
-            (player_id, season, game_date, opponent, min, pts, reb, ast, stl, blk)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (player_id, season, game_date) DO UPDATE
-            SET min = EXCLUDED.min, pts = EXCLUDED.pts, reb = EXCLUDED.reb,
-                ast = EXCLUDED.ast, stl = EXCLUDED.stl, blk = EXCLUDED.blk
-            RETURNING game_log_id;
-            """,
-            (
-                player_id,
-                season_string,
-                game_date,
-                stats["opponent"],
-                stats["min"],
-                stats["pts"],
-                stats["reb"],
-                stats["ast"],
-                stats["stl"],
-                stats["blk"],
-            ),
-        )
-        result = cur.fetchone()
-        return result[0] if result else None
-
-
-def upsert_advanced_stats(conn, game_log_id, stats):
-    """Insert or update advanced stats for a game log."""
-    # Skip if no advanced stats available
-    if stats.get('ortg') is None:
-        return False
-
-    with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO advanced_box_scores
-            (game_log_id, true_shooting_percentage, effective_fg_percentage,
-             offensive_rating, defensive_rating, net_rating, usage_percentage)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (game_log_id) DO UPDATE SET
-                true_shooting_percentage = EXCLUDED.true_shooting_percentage,
-                effective_fg_percentage = EXCLUDED.effective_fg_percentage,
-                offensive_rating = EXCLUDED.offensive_rating,
-                defensive_rating = EXCLUDED.defensive_rating,
-                net_rating = EXCLUDED.net_rating,
-                usage_percentage = EXCLUDED.usage_percentage
-            RETURNING game_log_id
-        """, (
-            game_log_id,
-            stats['ts_pct'],
-            stats['efg_pct'],
-            stats['ortg'],
-            stats['drtg'],
-            stats['net_rtg'],
-            stats['usg_pct'],
-        ))
-        return cur.fetchone() is not None
+def upsert_advanced_stats_batch(cur, rows):
+    """Insert or update advanced stats for many game logs in one batch.
 
+    Each row is (game_log_id, ts_pct, efg_pct, ortg, drtg, net_rtg, usg_pct),
+    loaded through a temp table the same way as insert_game_logs.
+    """
+    if not rows:
+        return 0
 
-def process_date(conn, target_date, season_string, dry_run=False):
-    """Process all stats for all games on a specific date."""
+    # Same session-lifetime stage table as insert_game_logs
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS advanced_stats_stage (
+            game_log_id INT,
+            true_shooting_percentage REAL,
+            effective_fg_percentage REAL,
+            offensive_rating REAL,
+            defensive_rating REAL,
+            net_rating REAL,
+            usage_percentage REAL
+        )
+    """)
+    cur.execute("TRUNCATE advanced_stats_stage")
+    with cur.copy("COPY advanced_stats_stage FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row(row)
+    cur.execute("""
+        INSERT INTO advanced_box_scores
+        (game_log_id, true_shooting_percentage, effective_fg_percentage,
+         offensive_rating, defensive_rating, net_rating, usage_percentage)
+        SELECT game_log_id, true_shooting_percentage, effective_fg_percentage,
+               offensive_rating, defensive_rating, net_rating, usage_percentage
+        FROM advanced_stats_stage
+        ON CONFLICT (game_log_id) DO UPDATE SET
+            true_shooting_percentage = EXCLUDED.true_shooting_percentage,
+            effective_fg_percentage = EXCLUDED.effective_fg_percentage,
+            offensive_rating = EXCLUDED.offensive_rating,
+            defensive_rating = EXCLUDED.defensive_rating,
+            net_rating = EXCLUDED.net_rating,
+            usage_percentage = EXCLUDED.usage_percentage
+    """)
+    return len(rows)
+
+
+def process_date(conn, target_date, season_string, dry_run=False, home_teams=None):
+    """Process all stats for all games on a specific date.
+
+    home_teams can be passed in when the date's games are already known
+    (e.g. from the season schedule); otherwise the scoreboard is fetched.
+    """
     print(f"\nProcessing {target_date.isoformat()}...")
 
-    home_teams = get_games_on_date(target_date)
+    if home_teams is None:
+        home_teams = get_games_on_date(target_date)
 
     if not home_teams:
         print("  No games found")
@@ -451,20 +319,20 @@ def process_date(conn, target_date, season_string, dry_run=False):
 
     print(f"  Found {len(home_teams)} games: {', '.join(home_teams)}")
 
-    total_basic = 0
-    total_advanced = 0
     all_players_stats = []
 
-    for home_team in home_teams:
-        random_delay(3, 5)
-
-        players_stats = fetch_all_stats_for_game(target_date, home_team)
+    # Fetch the games concurrently; the shared rate limiter keeps requests spaced out
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(
+            fetch_all_stats_for_game, [target_date] * len(home_teams), home_teams
+        ))
 
+    for home_team, players_stats in zip(home_teams, results):
         if not players_stats:
             print(f"    No stats found for {home_team} game")
             continue
 
-        advanced_count = sum(1 for p in players_stats if p.get('ortg') is not None)
+        advanced_count = sum(1 for p in players_stats if p.ortg is not None)
         print(f"    {home_team} game: {len(players_stats)} players ({advanced_count} with advanced stats)")
         all_players_stats.extend(players_stats)
 
@@ -474,19 +342,32 @@ def process_date(conn, target_date, season_string, dry_run=False):
     if dry_run:
         print(f"\n  Sample stats (first 5):")
         for stats in all_players_stats[:5]:
-            adv = f"ORtg={stats['ortg']:.0f}" if stats.get('ortg') else "no advanced"
-            print(f"    {stats['name']} ({stats['team']}): {stats['pts']} pts, {stats['reb']} reb, {stats['ast']} ast, {adv}")
-        return len(all_players_stats), sum(1 for p in all_players_stats if p.get('ortg')), 0
-
-    # Insert into database
-    for stats in all_players_stats:
-        player_id = get_or_create_player(conn, stats['name'], stats['team'])
-        game_log_id = insert_game_log(conn, player_id, target_date, stats, season_string)
-
-        if game_log_id:
-            total_basic += 1
-            if upsert_advanced_stats(conn, game_log_id, stats):
-                total_advanced += 1
+            adv = f"ORtg={stats.ortg:.0f}" if stats.ortg else "no advanced"
+            print(f"    {stats.name} ({stats.team}): {stats.pts} pts, {stats.reb} reb, {stats.ast} ast, {adv}")
+        return len(all_players_stats), sum(1 for p in all_players_stats if p.ortg), 0
+
+    # Insert into database: one transaction and one cursor for the whole date,
+    # with one batch per table
+    with conn.transaction(), conn.cursor() as cur:
+        sync_players(conn, PLAYER_ID_CACHE, {stats.name: stats.team for stats in all_players_stats})
+        player_stats = {PLAYER_ID_CACHE[stats.name][0]: stats for stats in all_players_stats}
+        game_log_ids = insert_game_logs(cur, target_date, season_string, player_stats)
+        total_basic = len(game_log_ids)
+
+        total_advanced = upsert_advanced_stats_batch(cur, [
+            (
+                game_log_ids[player_id],
+                stats.ts_pct,
+                stats.efg_pct,
+                stats.ortg,
+                stats.drtg,
+                stats.net_rtg,
+                stats.usg_pct,
+            )
+            for player_id, stats in player_stats.items()
+            # Skip if no advanced stats available
+            if player_id in game_log_ids and stats.ortg is not None
+        ])
 
     return len(all_players_stats), total_advanced, total_basic
 
@@ -512,9 +393,12 @@ def process_yesterday():
     with get_db_connection() as conn:
         log_connection_info(conn)
         setup_database(conn)
+        PLAYER_ID_CACHE.update(load_player_cache(conn))
+        # End the lookup's implicit transaction so process_date's
+        # conn.transaction() is a real transaction, not a savepoint
+        conn.commit()
 
         processed, advanced, inserted = process_date(conn, yesterday, season_string)
-        conn.commit()
 
         print("\n" + "=" * 60)
         print(f"Complete! {inserted} game logs, {advanced} advanced stats inserted.")
@@ -550,7 +434,6 @@ def main(season_end_year=2026):
             if home_teams:
                 sample_date = test_date
                 break
-            random_delay(1, 2)
 
         if not sample_date:
             print("No games found in the last 5 days")
@@ -566,15 +449,43 @@ def main(season_end_year=2026):
         log_connection_info(conn)
         setup_database(conn)
 
+        # Find every game date up front; days without games are skipped
+        schedule = get_season_schedule(season_end_year, season_start, end_date)
+        if schedule is None:
+            print("Falling back to checking each date's scoreboard")
+        else:
+            print(f"Schedule: {len(schedule)} dates with games")
+            # Dates this script stored in an earlier run don't need to be
+            # fetched again; dates with basic logs only still need advanced stats
+            for completed_date in get_completed_dates(
+                conn, season_string, schedule, require_advanced=True
+            ):
+                del schedule[completed_date]
+            print(f"Dates still to fetch: {len(schedule)}")
+
+        PLAYER_ID_CACHE.update(load_player_cache(conn))
+        # End the lookups' implicit transaction so each date's
+        # conn.transaction() in process_date commits on its own
+        conn.commit()
+
         current_date = season_start
         total_basic = 0
         total_advanced = 0
 
         while current_date <= end_date:
-            _, advanced, basic = process_date(conn, current_date, season_string)
+            if schedule is None:
+                home_teams = None
+            elif current_date in schedule:
+                home_teams = schedule[current_date]
+            else:
+                current_date += timedelta(days=1)
+                continue
+
+            _, advanced, basic = process_date(
+                conn, current_date, season_string, home_teams=home_teams
+            )
             total_basic += basic
             total_advanced += advanced
-            conn.commit()
             current_date += timedelta(days=1)
 
         print("\n" + "=" * 60)
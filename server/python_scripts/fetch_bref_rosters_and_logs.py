@@ -4,28 +4,43 @@ Fetch NBA player rosters and game logs from Basketball Reference.
 This script replaces fetch_team_rosters_and_logs.py to avoid NBA API
 datacenter IP blocking issues in GitHub Actions.
 
-Uses basketball_reference_web_scraper library which is more reliable.
+Uses basketball_reference_web_scraper's page parsers, with pages fetched
+over a shared keep-alive session.
 
 Run this for initial data population or full season updates.
 
 Usage:
-    python fetch_bref_rosters_and_logs.py [season_end_year]
+    python fetch_bref_rosters_and_logs.py [season_end_year] [--backfill]
 
 Examples:
     python fetch_bref_rosters_and_logs.py 2024  # 2023-24 season
     python fetch_bref_rosters_and_logs.py 2025  # 2024-25 season
     python fetch_bref_rosters_and_logs.py 2026  # 2025-26 season (default)
+    python fetch_bref_rosters_and_logs.py 2025 --backfill  # load the season with one COPY
 """
 
-import os
 import sys
-import time
-import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
-
-import psycopg
-from dotenv import load_dotenv
-from basketball_reference_web_scraper import client
+from operator import itemgetter
+
+import lxml.html
+from basketball_reference_web_scraper.data import Team
+from basketball_reference_web_scraper.html import DailyLeadersPage, PlayerSeasonTotalTable
+from basketball_reference_web_scraper.parser_service import ParserService
+
+from bref_common import (
+    MAX_WORKERS,
+    fetch_page,
+    flush_game_logs,
+    get_completed_dates,
+    get_season_schedule,
+    load_player_cache,
+    setup_database,
+    sync_players,
+)
+from db import get_db_connection, log_connection_info
 
 # Season start dates (approximate - actual dates vary slightly)
 SEASON_START_DATES = {
@@ -43,6 +58,26 @@ SEASON_END_DATES = {
 
 TEST_MODE = False
 
+# Dates fetched ahead of the database writes before fetching pauses
+PREFETCH_DAYS = 6
+
+# Game logs buffered across dates before they're upserted and committed
+WRITE_BATCH_ROWS = 1000
+
+BASE_URL = "https://www.basketball-reference.com"
+
+# The scraper library's client opens a new connection per call, so pages are
+# fetched over the shared session (see bref_common.fetch_page) and only
+# parsed by the library
+PARSER = ParserService()
+
+# Box score fields used for a game log, fetched from each row in one call
+BOX_SCORE_STATS = itemgetter(
+    "made_field_goals", "made_three_point_field_goals", "made_free_throws",
+    "offensive_rebounds", "defensive_rebounds", "assists", "steals", "blocks",
+    "seconds_played",
+)
+
 
 def get_season_config(season_end_year):
     """Get season configuration for a given end year."""
@@ -88,95 +123,18 @@ TEAM_TO_ABBR = {
     "WASHINGTON WIZARDS": "WAS",
 }
 
-
-def get_db_connection():
-    """Get a database connection."""
-    load_dotenv()
-    database_url = os.getenv("DATABASE_URL")
-    if database_url:
-        return psycopg.connect(database_url, sslmode="require")
-
-    return psycopg.connect(
-        dbname=os.getenv("PGDATABASE", "nba_stats"),
-        user=os.getenv("PGUSER", "christiankim"),
-        password=os.getenv("PGPASSWORD", ""),
-        host=os.getenv("PGHOST", "localhost"),
-        port=os.getenv("PGPORT", "5432"),
-    )
-
-
-def log_connection_info(conn):
-    """Log database connection details."""
-    info = conn.info
-    print(f"Connected to DB: {info.dbname} as {info.user}@{info.host}:{info.port}")
-
-
-def setup_database(conn):
-    """Ensure required tables exist."""
-    with conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS players (
-                player_id SERIAL PRIMARY KEY,
-                full_name VARCHAR(255) NOT NULL,
-                team_abbreviation VARCHAR(5),
-                headshot_url VARCHAR(255)
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS player_game_logs (
-                game_log_id SERIAL PRIMARY KEY,
-                player_id INT REFERENCES players(player_id),
-                season VARCHAR(10) NOT NULL,
-                game_date DATE NOT NULL,
-                opponent VARCHAR(5),
-                min REAL,
-                pts INT,
-                reb INT,
-                ast INT,
-                stl INT,
-                blk INT,
-                UNIQUE(player_id, season, game_date)
-            );
-        """)
-    conn.commit()
+# Team enum member -> abbreviation, built once so lookups are a single dict get
+TEAM_ENUM_TO_ABBR = {
+    team: TEAM_TO_ABBR.get(team_name, team_name[:3])
+    for team, team_name in ((team, team.name.replace("_", " ")) for team in Team)
+}
 
 
 def team_enum_to_abbr(team_enum):
     """Convert Team enum to abbreviation."""
     if team_enum is None:
         return None
-    team_name = str(team_enum).replace("Team.", "").replace("_", " ")
-    return TEAM_TO_ABBR.get(team_name, team_name[:3])
-
-
-def get_or_create_player(conn, player_name, team_abbr):
-    """Get player_id by name, or create new player if not exists."""
-    with conn.cursor() as cur:
-        cur.execute(
-            "SELECT player_id FROM players WHERE full_name = %s",
-            (player_name,)
-        )
-        row = cur.fetchone()
-        if row:
-            # Update team if changed
-            cur.execute(
-                "UPDATE players SET team_abbreviation = %s WHERE player_id = %s",
-                (team_abbr, row[0])
-            )
-            return row[0]
-
-        # Create new player with explicit ID (table doesn't use SERIAL)
-        cur.execute(
-            """
-            INSERT INTO players (player_id, full_name, team_abbreviation)
-            VALUES ((SELECT COALESCE(MAX(player_id), 0) + 1 FROM players), %s, %s)
-            RETURNING player_id
-            """,
-            (player_name, team_abbr)
-        )
-        player_id = cur.fetchone()[0]
-        print(f"  Created new player: {player_name} (ID: {player_id})")
-        return player_id
+    return TEAM_ENUM_TO_ABBR.get(team_enum)
 
 
 def calculate_points(box_score):
@@ -196,27 +154,96 @@ def calculate_rebounds(box_score):
     return orb + drb
 
 
-def random_delay(min_sec=3, max_sec=5):
-    """Add delay to respect rate limits (20 req/min = 3 sec minimum)."""
-    time.sleep(random.uniform(min_sec, max_sec))
+def fetch_season_totals(season_end_year):
+    """Fetch season totals for every player in a season."""
+    response = fetch_page(f"{BASE_URL}/leagues/NBA_{season_end_year}_totals.html")
+    response.raise_for_status()
+    table = PlayerSeasonTotalTable(html=lxml.html.fromstring(response.content))
+    return PARSER.parse_player_season_totals(totals=table.rows)
 
 
 def fetch_box_scores_for_date(target_date):
     """Fetch all player box scores for a specific date."""
+    url = (f"{BASE_URL}/friv/dailyleaders.cgi"
+           f"?month={target_date.month}&day={target_date.day}&year={target_date.year}")
+
     try:
-        box_scores = client.player_box_scores(
-            day=target_date.day,
-            month=target_date.month,
-            year=target_date.year
-        )
-        return box_scores
+        # Completed dates come from the on-disk cache on reruns (e.g. after a
+        # crashed --backfill); dates without games redirect away from the page
+        response = fetch_page(url, target_date, allow_redirects=False)
+        response.raise_for_status()
+        if response.status_code != 200:
+            return []
+        page = DailyLeadersPage(html=lxml.html.fromstring(response.content))
+        return PARSER.parse_player_box_scores(box_scores=page.daily_leaders)
     except Exception as exc:
         print(f"  Error fetching box scores for {target_date}: {exc}")
         return []
 
 
-def main(season_end_year=2026):
-    """Main function to fetch rosters and game logs for a season."""
+def prefetch_box_scores(executor, dates):
+    """Yield (date, box_scores) in date order while later dates download.
+
+    At most PREFETCH_DAYS fetches are queued ahead of the consumer, so a
+    failed write stops the scrape instead of waiting out the whole season.
+    """
+    pending = deque()
+    for target_date in dates:
+        pending.append((target_date, executor.submit(fetch_box_scores_for_date, target_date)))
+        if len(pending) >= PREFETCH_DAYS:
+            fetched_date, future = pending.popleft()
+            yield fetched_date, future.result()
+    while pending:
+        fetched_date, future = pending.popleft()
+        yield fetched_date, future.result()
+
+
+def copy_game_logs(conn, rows):
+    """Bulk-load game log rows with COPY and merge them into player_game_logs.
+
+    COPY can't resolve conflicts, so rows go into a temp table first and are
+    upserted from there in one statement. Returns the number of rows written.
+    """
+    with conn.cursor() as cur:
+        # Reused and emptied if this session already created it
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS player_game_logs_stage (
+                player_id INT,
+                season VARCHAR(10),
+                game_date DATE,
+                opponent VARCHAR(5),
+                min REAL,
+                pts INT,
+                reb INT,
+                ast INT,
+                stl INT,
+                blk INT
+            )
+        """)
+        cur.execute("TRUNCATE player_game_logs_stage")
+        with cur.copy("COPY player_game_logs_stage FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+        cur.execute("""
+            INSERT INTO player_game_logs
+            (player_id, season, game_date, opponent, min, pts, reb, ast, stl, blk)
+            SELECT DISTINCT ON (player_id, season, game_date)
+                player_id, season, game_date, opponent, min, pts, reb, ast, stl, blk
+            FROM player_game_logs_stage
+            ON CONFLICT (player_id, season, game_date) DO UPDATE
+            SET min = EXCLUDED.min, pts = EXCLUDED.pts, reb = EXCLUDED.reb,
+                ast = EXCLUDED.ast, stl = EXCLUDED.stl, blk = EXCLUDED.blk;
+        """)
+        return cur.rowcount
+
+
+def main(season_end_year=2026, backfill=False):
+    """Main function to fetch rosters and game logs for a season.
+
+    With backfill=True, rows for every date are held in memory and written
+    once at the end through COPY instead of being upserted day by day, all
+    in a single transaction.
+    """
     config = get_season_config(season_end_year)
     season_string = config["string"]
     season_start = config["start_date"]
@@ -226,6 +253,8 @@ def main(season_end_year=2026):
     print("Fetch Rosters and Game Logs from Basketball Reference")
     print("=" * 60)
     print(f"Season: {season_string}")
+    if backfill:
+        print("Mode: backfill (single COPY load at the end)")
 
     # For past seasons, use season end date; for current season, use today
     today = date.today()
@@ -241,7 +270,7 @@ def main(season_end_year=2026):
         # Fetch a sample of data and display it
         print("Fetching season totals to preview players...")
         try:
-            season_totals = client.players_season_totals(season_end_year=season_end_year)
+            season_totals = fetch_season_totals(season_end_year)
             print(f"Found {len(season_totals)} players in {season_string} season")
             print("\nSample players (first 5):")
             for i, player in enumerate(season_totals[:5]):
@@ -252,8 +281,6 @@ def main(season_end_year=2026):
             print(f"Error fetching season totals: {exc}")
             return
 
-        random_delay(3, 5)
-
         # Fetch one day of box scores as sample
         sample_date = today - timedelta(days=1)
         print(f"\nFetching sample box scores for {sample_date}...")
@@ -284,91 +311,101 @@ def main(season_end_year=2026):
     with get_db_connection() as conn:
         log_connection_info(conn)
         setup_database(conn)
+        if backfill:
+            # Anything lost in a crash is re-scraped on the next run, so
+            # don't wait for WAL flushes on every commit
+            conn.execute("SET synchronous_commit = off")
 
         # Step 1: Fetch all players from season totals to get roster
         print("\nFetching season totals to get all players...")
         try:
-            season_totals = client.players_season_totals(season_end_year=season_end_year)
+            season_totals = fetch_season_totals(season_end_year)
             print(f"Found {len(season_totals)} players in {season_string} season")
         except Exception as exc:
             print(f"Error fetching season totals: {exc}")
             return
 
         # Create/update players in database
-        player_map = {}  # name -> player_id
+        player_cache = load_player_cache(conn)  # name -> (player_id, team)
+        player_teams = {}
         for player in season_totals:
             name = player.get("name")
-            team = team_enum_to_abbr(player.get("team"))
             if name:
-                player_id = get_or_create_player(conn, name, team)
-                player_map[name] = player_id
+                player_teams[name] = team_enum_to_abbr(player.get("team"))
+        sync_players(conn, player_cache, player_teams)
         conn.commit()
-        print(f"Processed {len(player_map)} players")
-
-        random_delay(3, 5)
+        print(f"Processed {len(player_teams)} players")
 
         # Step 2: Fetch box scores for each day of the season
-        start_date = season_start
-
-        insert_query = """
-            INSERT INTO player_game_logs
-            (player_id, season, game_date, opponent, min, pts, reb, ast, stl, blk)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (player_id, season, game_date) DO UPDATE
-            SET min = EXCLUDED.min, pts = EXCLUDED.pts, reb = EXCLUDED.reb,
-                ast = EXCLUDED.ast, stl = EXCLUDED.stl, blk = EXCLUDED.blk;
-        """
+        schedule = get_season_schedule(season_end_year, season_start, end_date)
+        if schedule is None:
+            print("Falling back to fetching every date")
+            dates = [season_start + timedelta(days=offset)
+                     for offset in range((end_date - season_start).days + 1)]
+        else:
+            # Dates whose scheduled games all have logs from an earlier run
+            # don't need to be fetched again; partly written dates do
+            completed_dates = get_completed_dates(conn, season_string, schedule)
+            dates = sorted(schedule.keys() - completed_dates)
+        print(f"Dates still to fetch: {len(dates)}")
 
-        current_date = start_date
         total_games = 0
         total_inserted = 0
+        pending_rows = []
+        backfill_rows = []
 
-        while current_date <= end_date:
-            print(f"\nFetching games for {current_date.isoformat()}...")
-
-            box_scores = fetch_box_scores_for_date(current_date)
+        # Dates are fetched concurrently ahead of the writes; the shared rate
+        # limiter keeps requests spaced out and results arrive in date order
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for current_date, box_scores in prefetch_box_scores(executor, dates):
+                print(f"\nProcessing games for {current_date.isoformat()}...")
 
-            if not box_scores:
-                print("  No games on this date")
-                current_date += timedelta(days=1)
-                random_delay(1, 2)
-                continue
+                if not box_scores:
+                    print("  No games on this date")
+                    continue
 
-            print(f"  Found {len(box_scores)} player performances")
+                print(f"  Found {len(box_scores)} player performances")
 
-            with conn.cursor() as cur:
+                # Create any players not in our cache
+                new_players = {}
                 for box in box_scores:
                     name = box.get("name")
-                    if name not in player_map:
-                        # Create player if not in our map
-                        team = team_enum_to_abbr(box.get("team"))
-                        player_id = get_or_create_player(conn, name, team)
-                        player_map[name] = player_id
-                    else:
-                        player_id = player_map[name]
-
-                    # Calculate stats
-                    opponent = team_enum_to_abbr(box.get("opponent"))
-                    seconds = box.get("seconds_played", 0) or 0
-                    minutes = round(seconds / 60)
-                    pts = calculate_points(box)
-                    reb = calculate_rebounds(box)
-                    ast = box.get("assists", 0) or 0
-                    stl = box.get("steals", 0) or 0
-                    blk = box.get("blocks", 0) or 0
-
-                    cur.execute(
-                        insert_query,
-                        (player_id, season_string, current_date, opponent,
-                         minutes, pts, reb, ast, stl, blk)
+                    if name not in player_cache and name not in new_players:
+                        new_players[name] = team_enum_to_abbr(box.get("team"))
+                if new_players:
+                    sync_players(conn, player_cache, new_players)
+
+                rows = []
+                for box in box_scores:
+                    player_id = player_cache[box["name"]][0]
+
+                    # Calculate stats (same formulas as calculate_points/calculate_rebounds)
+                    fg, fg3, ft, orb, drb, ast, stl, blk, seconds = (
+                        value or 0 for value in BOX_SCORE_STATS(box)
                     )
-                    if cur.rowcount == 1:
-                        total_inserted += 1
-                    total_games += 1
 
+                    rows.append((player_id, season_string, current_date,
+                                 team_enum_to_abbr(box["opponent"]), round(seconds / 60),
+                                 fg * 2 + fg3 + ft, orb + drb, ast, stl, blk))
+
+                total_games += len(rows)
+                if backfill:
+                    # Players created for this date commit with the COPY load
+                    backfill_rows.extend(rows)
+                else:
+                    # Write several days per statement instead of one per day
+                    pending_rows.extend(rows)
+                    if len(pending_rows) >= WRITE_BATCH_ROWS:
+                        total_inserted += flush_game_logs(conn, pending_rows)
+                        pending_rows = []
+
+        if pending_rows:
+            total_inserted += flush_game_logs(conn, pending_rows)
+
+        if backfill_rows:
+            print(f"\nLoading {len(backfill_rows)} game logs with COPY...")
+            total_inserted = copy_game_logs(conn, backfill_rows)
             conn.commit()
-            current_date += timedelta(days=1)
-            random_delay(3, 5)  # Respect rate limits
 
         print("\n" + "=" * 60)
         print(f"Complete! Processed {total_games} box scores, {total_inserted} new records.")
@@ -376,16 +413,20 @@ def main(season_end_year=2026):
 
 
 if __name__ == "__main__":
+    args = sys.argv[1:]
+    backfill = "--backfill" in args
+    args = [arg for arg in args if arg != "--backfill"]
+
     # Parse command-line argument for season end year
-    if len(sys.argv) > 1:
+    if args:
         try:
-            year = int(sys.argv[1])
+            year = int(args[0])
             if year < 2000 or year > 2030:
                 print(f"Invalid year: {year}. Use a year between 2000-2030.")
                 sys.exit(1)
-            main(season_end_year=year)
+            main(season_end_year=year, backfill=backfill)
         except ValueError:
-            print(f"Invalid argument: {sys.argv[1]}. Please provide a year (e.g., 2024, 2025, 2026).")
+            print(f"Invalid argument: {args[0]}. Please provide a year (e.g., 2024, 2025, 2026).")
             sys.exit(1)
     else:
-        main()  # Default to 2026
+        main(backfill=backfill)  # Default to 2026
@@ -8,42 +8,25 @@ Can be run locally or in GitHub Actions (player search endpoint is
 less likely to be blocked than stats endpoints).
 """
 
-import os
+import re
 import time
 import random
 import unicodedata
+from functools import lru_cache
 
-import psycopg
-from dotenv import load_dotenv
 from nba_api.stats.static import players as nba_players
 
+from db import get_db_connection, log_connection_info
+
 # Configuration
 TEST_MODE = False
 HEADSHOT_URL_TEMPLATE = "https://cdn.nba.com/headshots/nba/latest/1040x760/{player_id}.png"
 
-
-def get_db_connection():
-    """Get a database connection."""
-    load_dotenv()
-    database_url = os.getenv("DATABASE_URL")
-    if database_url:
-        return psycopg.connect(database_url, sslmode="require")
-
-    return psycopg.connect(
-        dbname=os.getenv("PGDATABASE", "nba_stats"),
-        user=os.getenv("PGUSER", "christiankim"),
-        password=os.getenv("PGPASSWORD", ""),
-        host=os.getenv("PGHOST", "localhost"),
-        port=os.getenv("PGPORT", "5432"),
-    )
-
-
-def log_connection_info(conn):
-    """Log database connection details."""
-    info = conn.info
-    print(f"Connected to DB: {info.dbname} as {info.user}@{info.host}:{info.port}")
+# Generational suffixes dropped when matching names, e.g. "jaren jackson jr."
+SUFFIX_RE = re.compile(r' (?:jr\.?|sr\.?|iii|ii|iv)$')
 
 
+@lru_cache(maxsize=8192)
 def normalize_name(name):
     """Normalize player name for matching.
 
@@ -59,37 +42,43 @@ def normalize_name(name):
     normalized = normalized.lower()
 
     # Remove common suffixes
-    for suffix in [' jr.', ' jr', ' sr.', ' sr', ' iii', ' ii', ' iv']:
-        if normalized.endswith(suffix):
-            normalized = normalized[:-len(suffix)]
+    normalized = SUFFIX_RE.sub('', normalized)
 
     return normalized.strip()
 
 
-def find_nba_player_id(player_name):
-    """Find NBA player ID by name using nba_api static data."""
-    normalized_search = normalize_name(player_name)
+def build_player_index():
+    """Index nba_api's static players by normalized full name and first/last name.
 
-    # Get all NBA players (this is static data, no API call)
-    all_players = nba_players.get_players()
+    Built once per run so each lookup is a dict get instead of a scan over
+    every NBA player. The first player in nba_api's order wins a collision,
+    matching the order the lookups used to scan in.
+    """
+    by_full_name = {}
+    by_first_last = {}
+    for player in nba_players.get_players():
+        normalized = normalize_name(player['full_name'])
+        by_full_name.setdefault(normalized, player['id'])
+        parts = normalized.split()
+        if len(parts) >= 2:
+            by_first_last.setdefault((parts[0], parts[-1]), player['id'])
+    return by_full_name, by_first_last
+
+
+def find_nba_player_id(player_name, player_index):
+    """Find NBA player ID by name using an index from build_player_index()."""
+    by_full_name, by_first_last = player_index
+    normalized_search = normalize_name(player_name)
 
     # Try exact match first
-    for player in all_players:
-        if normalize_name(player['full_name']) == normalized_search:
-            return player['id']
+    nba_id = by_full_name.get(normalized_search)
+    if nba_id:
+        return nba_id
 
     # Try partial match (first and last name)
     search_parts = normalized_search.split()
     if len(search_parts) >= 2:
-        first_name = search_parts[0]
-        last_name = search_parts[-1]
-
-        for player in all_players:
-            player_normalized = normalize_name(player['full_name'])
-            player_parts = player_normalized.split()
-            if len(player_parts) >= 2:
-                if player_parts[0] == first_name and player_parts[-1] == last_name:
-                    return player['id']
+        return by_first_last.get((search_parts[0], search_parts[-1]))
 
     return None
 
@@ -121,29 +110,36 @@ def main():
             players_to_update = players_to_update[:20]
             print(f"TEST_MODE: Processing only {len(players_to_update)} players")
 
-        updated = 0
+        updates = []  # (player_id, headshot_url)
         not_found = 0
+        player_index = build_player_index()
 
         for player_id, full_name in players_to_update:
-            nba_id = find_nba_player_id(full_name)
+            nba_id = find_nba_player_id(full_name, player_index)
 
             if nba_id:
-                headshot_url = HEADSHOT_URL_TEMPLATE.format(player_id=nba_id)
+                updates.append((player_id, HEADSHOT_URL_TEMPLATE.format(player_id=nba_id)))
 
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE players SET headshot_url = %s WHERE player_id = %s",
-                        (headshot_url, player_id)
-                    )
-
-                updated += 1
-                if TEST_MODE or updated <= 10:
+                if TEST_MODE or len(updates) <= 10:
                     print(f"  {full_name} -> NBA ID {nba_id}")
             else:
                 not_found += 1
                 if TEST_MODE or not_found <= 10:
                     print(f"  {full_name} -> NOT FOUND")
 
+        updated = len(updates)
+        if updates:
+            # Write every matched headshot in one statement
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE players SET headshot_url = v.headshot_url
+                    FROM unnest(%s::int[], %s::varchar[]) AS v(player_id, headshot_url)
+                    WHERE players.player_id = v.player_id
+                    """,
+                    [list(column) for column in zip(*updates)]
+                )
+
         conn.commit()
 
         print("\n" + "=" * 60)